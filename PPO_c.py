@@ -1,10 +1,23 @@
 import torch
 import torch.nn as nn
-from torch.distributions import MultivariateNormal
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributions import Normal
 import gym
 import numpy as np
+import numba
+import os
+from concurrent.futures import ThreadPoolExecutor
 torch.set_default_tensor_type(torch.FloatTensor)
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# when launched with `torchrun --nproc_per_node=G PPO_c.py` every process
+# drives one GPU and gradients are averaged over the processes
+rank = int(os.environ.get("RANK", 0))
+local_rank = int(os.environ.get("LOCAL_RANK", 0))
+world_size = int(os.environ.get("WORLD_SIZE", 1))
+device = torch.device("cuda:{}".format(local_rank) if torch.cuda.is_available() else "cpu")
+# TF32 matmuls for the fp32 training path
+torch.backends.cuda.matmul.allow_tf32 = True
 
 ############## Hyperparameters ##############
 env_name = "BipedalWalker-v3"
@@ -13,205 +26,551 @@ solved_reward = 300         # stop training if average_reward > solved_reward
 log_interval = 20           # print average reward in the interval
 max_episodes = 10000        # max training episodes
 max_timesteps = 1500        # max timesteps in one episode
+num_envs = 8                # number of envs stepped in parallel
     
-update_timestep = 4000      # update policy every n timesteps
-action_std = 0.5            # constant std for action distribution (Multivariate Normal)
-K_epochs = 80               # update policy for K epochs
+update_timestep = 4000      # update policy every n timesteps (summed over all envs)
+action_std = 0.5            # constant std for action distribution (diagonal Normal)
+K_epochs = 10               # update policy for K epochs (passes over the mini-batches)
+mini_batch_size = 64        # transitions per gradient step within an epoch
 eps_clip = 0.2              # clip parameter for PPO
+value_coef = 0.5            # weight of the value loss
+entropy_coef = 0.01         # weight of the entropy bonus
 gamma = 0.99                # discount factor
+gae_lambda = 0.95           # lambda of the generalized advantage estimate
     
 lr = 0.0003                 # parameters for Adam optimizer
 betas = (0.9, 0.999)
     
 random_seed = None
+compile_policy = False      # fuse the actor/critic MLPs with torch.compile
+fused_loss = False          # compute the PPO loss with a custom CUDA kernel (needs nvcc)
+async_rollouts = False      # collect the next rollout in a background thread during the update
+
+@numba.njit(cache=True)
+def discounted_returns(rewards, masks, gamma):
+    # out[t] = rewards[t] + gamma * masks[t] * out[t+1] over a (T, num_envs) rollout,
+    # masks is 0 at terminals so each env restarts after its episodes end
+    out = np.empty_like(rewards)
+    r = np.zeros(rewards.shape[1], dtype=rewards.dtype)
+    for i in range(rewards.shape[0]-1, -1, -1):
+        for n in range(rewards.shape[1]):
+            r[n] = rewards[i, n] + gamma * masks[i, n] * r[n]
+            out[i, n] = r[n]
+    return out
+
+# fused PPO loss: clipped surrogate, value and entropy terms reduced to the
+# mean loss in one kernel, with the matching elementwise backward
+fused_ppo_loss_source = """
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <algorithm>
+
+#define CHECK_INPUT(x, n)                                                   \
+    TORCH_CHECK(x.is_cuda(), #x " must be a CUDA tensor");                  \
+    TORCH_CHECK(x.scalar_type() == torch::kFloat32, #x " must be float32"); \
+    TORCH_CHECK(x.is_contiguous(), #x " must be contiguous");               \
+    TORCH_CHECK(x.numel() == n, #x " must have one element per sample")
+
+__global__ void fused_ppo_loss_kernel(const float* ratios, const float* advantages, const float* values,
+                                      const float* returns, const float* entropy, float eps_clip,
+                                      float value_coef, float entropy_coef, float* out, int n) {
+    extern __shared__ float partial[];
+    int tid = threadIdx.x;
+    float sum = 0.0f;
+    for (int i = blockIdx.x * blockDim.x + tid; i < n; i += blockDim.x * gridDim.x) {
+        float r = ratios[i];
+        float a = advantages[i];
+        float clipped = fminf(fmaxf(r, 1.0f - eps_clip), 1.0f + eps_clip);
+        float diff = values[i] - returns[i];
+        sum += -fminf(r * a, clipped * a) + value_coef * diff * diff - entropy_coef * entropy[i];
+    }
+    partial[tid] = sum;
+    __syncthreads();
+    for (int s = blockDim.x / 2; s > 0; s >>= 1) {
+        if (tid < s) partial[tid] += partial[tid + s];
+        __syncthreads();
+    }
+    if (tid == 0) atomicAdd(out, partial[0] / n);
+}
+
+__global__ void fused_ppo_loss_backward_kernel(const float* ratios, const float* advantages, const float* values,
+                                               const float* returns, const float* grad_out, float eps_clip,
+                                               float value_coef, float entropy_coef, float* grad_ratios,
+                                               float* grad_values, float* grad_entropy, int n) {
+    int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i >= n) return;
+    float g = grad_out[0] / n;
+    float r = ratios[i];
+    float a = advantages[i];
+    float clipped = fminf(fmaxf(r, 1.0f - eps_clip), 1.0f + eps_clip);
+    // the clipped branch is constant in the ratio, so only the unclipped one passes gradient
+    grad_ratios[i] = (r * a <= clipped * a) ? -a * g : 0.0f;
+    grad_values[i] = 2.0f * value_coef * (values[i] - returns[i]) * g;
+    grad_entropy[i] = -entropy_coef * g;
+}
+
+torch::Tensor fused_ppo_loss_forward(torch::Tensor ratios, torch::Tensor advantages, torch::Tensor values,
+                                     torch::Tensor returns, torch::Tensor entropy, double eps_clip,
+                                     double value_coef, double entropy_coef) {
+    int n = ratios.numel();
+    TORCH_CHECK(n > 0, "fused_ppo_loss needs a non-empty batch");
+    CHECK_INPUT(ratios, n);
+    CHECK_INPUT(advantages, n);
+    CHECK_INPUT(values, n);
+    CHECK_INPUT(returns, n);
+    CHECK_INPUT(entropy, n);
+    auto out = torch::zeros({}, ratios.options());
+    const int threads = 256;
+    const int blocks = std::min((n + threads - 1) / threads, 1024);
+    fused_ppo_loss_kernel<<<blocks, threads, threads * sizeof(float), at::cuda::getCurrentCUDAStream()>>>(
+        ratios.data_ptr<float>(), advantages.data_ptr<float>(), values.data_ptr<float>(),
+        returns.data_ptr<float>(), entropy.data_ptr<float>(), (float)eps_clip, (float)value_coef,
+        (float)entropy_coef, out.data_ptr<float>(), n);
+    return out;
+}
+
+std::vector<torch::Tensor> fused_ppo_loss_backward(torch::Tensor ratios, torch::Tensor advantages, torch::Tensor values,
+                                                   torch::Tensor returns, torch::Tensor grad_out, double eps_clip,
+                                                   double value_coef, double entropy_coef) {
+    int n = ratios.numel();
+    TORCH_CHECK(n > 0, "fused_ppo_loss needs a non-empty batch");
+    CHECK_INPUT(ratios, n);
+    CHECK_INPUT(advantages, n);
+    CHECK_INPUT(values, n);
+    CHECK_INPUT(returns, n);
+    CHECK_INPUT(grad_out, 1);
+    auto grad_ratios = torch::empty_like(ratios);
+    auto grad_values = torch::empty_like(values);
+    auto grad_entropy = torch::empty_like(ratios);
+    const int threads = 256;
+    const int blocks = (n + threads - 1) / threads;
+    fused_ppo_loss_backward_kernel<<<blocks, threads, 0, at::cuda::getCurrentCUDAStream()>>>(
+        ratios.data_ptr<float>(), advantages.data_ptr<float>(), values.data_ptr<float>(),
+        returns.data_ptr<float>(), grad_out.data_ptr<float>(), (float)eps_clip, (float)value_coef,
+        (float)entropy_coef, grad_ratios.data_ptr<float>(), grad_values.data_ptr<float>(),
+        grad_entropy.data_ptr<float>(), n);
+    return {grad_ratios, grad_values, grad_entropy};
+}
+"""
+
+fused_ppo_loss_cpp_source = """
+torch::Tensor fused_ppo_loss_forward(torch::Tensor ratios, torch::Tensor advantages, torch::Tensor values,
+                                     torch::Tensor returns, torch::Tensor entropy, double eps_clip,
+                                     double value_coef, double entropy_coef);
+std::vector<torch::Tensor> fused_ppo_loss_backward(torch::Tensor ratios, torch::Tensor advantages, torch::Tensor values,
+                                                   torch::Tensor returns, torch::Tensor grad_out, double eps_clip,
+                                                   double value_coef, double entropy_coef);
+"""
+
+fused_ppo_loss_module = None
+
+def load_fused_ppo_loss():
+    # compile the extension on first use, it needs nvcc
+    global fused_ppo_loss_module
+    if fused_ppo_loss_module is None:
+        from torch.utils.cpp_extension import load_inline
+        fused_ppo_loss_module = load_inline(
+                name="fused_ppo_loss",
+                cpp_sources=fused_ppo_loss_cpp_source,
+                cuda_sources=fused_ppo_loss_source,
+                functions=["fused_ppo_loss_forward", "fused_ppo_loss_backward"],
+                extra_cuda_cflags=["-O3", "--use_fast_math"])
+    return fused_ppo_loss_module
+
+class FusedPPOLoss(torch.autograd.Function):
+    # same value as ppo_loss: mean of -L_CLIP + value_coef * (values - returns)^2
+    # - entropy_coef * entropy, advantages and returns are treated as constants
+    @staticmethod
+    def forward(ctx, ratios, advantages, values, returns, entropy, eps_clip, value_coef, entropy_coef):
+        ctx.save_for_backward(ratios, advantages, values, returns)
+        ctx.coefs = (eps_clip, value_coef, entropy_coef)
+        return load_fused_ppo_loss().fused_ppo_loss_forward(
+                ratios, advantages, values, returns, entropy, eps_clip, value_coef, entropy_coef)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        ratios, advantages, values, returns = ctx.saved_tensors
+        grad_ratios, grad_values, grad_entropy = load_fused_ppo_loss().fused_ppo_loss_backward(
+                ratios, advantages, values, returns, grad_out.contiguous(), *ctx.coefs)
+        return grad_ratios, None, grad_values, None, grad_entropy, None, None, None
+
+def ppo_loss(ratios, advantages, values, returns, entropy, eps_clip, value_coef, entropy_coef):
+    # eager PPO loss: clipped surrogate, value and entropy terms averaged over the batch
+    L_CPI = ratios* advantages
+    L_CLIP = torch.min(L_CPI,torch.clamp(ratios,1-eps_clip,1+eps_clip)*advantages)
+    return (value_coef * F.mse_loss(values, returns, reduction='none') - L_CLIP - entropy_coef *entropy).mean()
+
+def check_fused_ppo_loss(ratios, advantages, values, returns, entropy, eps_clip, value_coef, entropy_coef):
+    # compare the fused kernels with the eager loss on one batch, loss and gradients
+    inputs = [t.detach().clone().requires_grad_() for t in (ratios, values, entropy)]
+    fused = FusedPPOLoss.apply(inputs[0], advantages, inputs[1], returns, inputs[2], eps_clip, value_coef, entropy_coef)
+    eager = ppo_loss(inputs[0], advantages, inputs[1], returns, inputs[2], eps_clip, value_coef, entropy_coef)
+    fused_grads = torch.autograd.grad(fused, inputs)
+    eager_grads = torch.autograd.grad(eager, inputs)
+    # --use_fast_math and the atomic block reduction change the rounding slightly
+    torch.testing.assert_close(fused, eager, rtol=1e-4, atol=1e-5)
+    for fused_grad, eager_grad in zip(fused_grads, eager_grads):
+        torch.testing.assert_close(fused_grad, eager_grad, rtol=1e-4, atol=1e-6)
 
 class ActorCritic(nn.Module):
     def __init__(self, state_dim, action_dim, action_std):
         super(ActorCritic,self).__init__()
-        # here activator tanh is adopted because action mean ranges -1 to 1
-        # actor : output the mean of the policy
-        self.actor =  nn.Sequential(
+        # trunk : feature extractor shared by the actor and the critic
+        self.trunk = nn.Sequential(
                 nn.Linear(state_dim, 64),
                 nn.Tanh(),
                 nn.Linear(64, 32),
-                nn.Tanh(),
-                nn.Linear(32, action_dim),
                 nn.Tanh()
                 )
-        # critic : estimate Advantage function 
-        self.critic = nn.Sequential(
-                nn.Linear(state_dim, 64),
-                nn.Tanh(),
-                nn.Linear(64, 32),
-                nn.Tanh(),
-                nn.Linear(32, 1)
+        # here activator tanh is adopted because action mean ranges -1 to 1
+        # actor : output the mean of the policy
+        self.actor_head = nn.Sequential(
+                nn.Linear(32, action_dim),
+                nn.Tanh()
                 )
-        # define the variance of the policy (here we adopt Gaussian policy)
-        self.action_var = torch.full((action_dim,), action_std*action_std).to(device)
-    def forward(self):
-        raise ImportError
-    def act(self,state,memory) :
-        action_mean = self.actor(state)
-        cov_mat = torch.diag(self.action_var).to(device)
-        distribution = MultivariateNormal(action_mean, cov_mat)
-        action = distribution.sample()
-        action_logprob = distribution.log_prob(action)
-
-        #log in the memory
-
-        memory.states.append(state)
-        memory.actions.append(action)
-        memory.logprobs.append(action_logprob)
-        # detach action from grad graph
-        return action.detach() 
+        # critic : estimate state value
+        self.critic_head = nn.Linear(32, 1)
+        # compile the trunk and both heads as one graph so the small Linear/Tanh
+        # chains can be fused; the distribution is still built in eager mode in
+        # act/evaluate. Every call site uses a fixed batch size (num_envs in act,
+        # mini_batch_size in evaluate, the rollout in update), so the shapes are static
+        self._heads = self.heads
+        if compile_policy:
+            self._heads = torch.compile(self.heads, mode="reduce-overhead", dynamic=False)
+        # define the std of the policy (here we adopt diagonal Gaussian policy);
+        # it is a positive constant, so the distributions built from it skip
+        # argument validation, which would sync with the device on every call
+        self.action_std = torch.full((action_dim,), action_std).to(device)
+    def forward(self, state, action):
+        # evaluate goes through forward so DDP can all-reduce its gradients
+        return self.evaluate(state, action)
+    def act(self,state) :
+        # only used for rollouts, so skip building the grad graph
+        with torch.inference_mode():
+            # sample in fp32 even if the actor runs in reduced precision
+            action_mean = self._heads(state)[0].float()
+            # independent action dims: sum the per-dim log probs
+            distribution = Normal(action_mean, self.action_std, validate_args=False)
+            action = distribution.sample()
+            action_logprob = distribution.log_prob(action).sum(-1)
+        return action, action_logprob
 
     def evaluate(self, state, action):
         # used in the update
-        action_mean = self.actor(state)
-        action_var= self.action_var.expand_as(action_mean)
-        cov_mat = torch.diag_embed(action_var).to(device)
+        action_mean, state_value = self._heads(state)
+        distribution = Normal(action_mean, self.action_std, validate_args=False)
+        action_logprob = distribution.log_prob(action).sum(-1)
+        dist_entropy = distribution.entropy().sum(-1)
+        return action_logprob, state_value, dist_entropy
+
+    def value(self, state):
+        return self._heads(state)[1]
+
+    def heads(self, state):
+        # the trunk runs once for both heads
+        features = self.trunk(state)
+        return self.actor_head(features), self.critic_head(features).squeeze(-1)
 
-        distribution = MultivariateNormal(action_mean, cov_mat)
-        cov_mat = torch.diag_embed(action_var).to(device)
-        action_logprob = distribution.log_prob(action)
-        dist_entropy = distribution.entropy()
-        state_value = self.critic(state)
-        return action_logprob, torch.squeeze(state_value), dist_entropy
+class RunningMeanStd:
+    # running mean and std of the value targets, merged batch by batch
+    def __init__(self):
+        self.mean = 0.0
+        self.var = 1.0
+        self.count = 1e-4
+
+    def update(self, x):
+        # batch moments are summed over all ranks so every rank keeps the same stats
+        x = x.double()
+        n, total, total_sq = all_reduce_sum([x.numel(), x.sum().item(), (x* x).sum().item()])
+        batch_mean = total / n
+        batch_var = max(total_sq / n - batch_mean* batch_mean, 0.0)
+        delta = batch_mean - self.mean
+        count = self.count + n
+        self.mean += delta* n / count
+        self.var = (self.var* self.count + batch_var* n + delta* delta* self.count* n / count) / count
+        self.count = count
+
+    @property
+    def std(self):
+        return np.sqrt(self.var) + 1e-8
 
 class PPO() :
-    def __init__(self, state_dim, action_dim, action_std, lr, betas, gamma, K_epochs, eps_clip):
+    def __init__(self, state_dim, action_dim, action_std, lr, betas, gamma, gae_lambda, K_epochs, eps_clip, mini_batch_size):
         self.lr = lr
         self.betas = betas
         self.gamma = gamma
+        self.gae_lambda = gae_lambda
         self.eps_clip = eps_clip
         self.K_epochs = K_epochs
+        self.mini_batch_size = mini_batch_size
+        # the critic predicts normalized values, so that raw returns (a fall costs -100)
+        # do not let the value loss swamp the surrogate in the shared trunk
+        self.return_rms = RunningMeanStd()
         
-        self.policy = ActorCritic(state_dim, action_dim, action_std).to(device)
+        # policy_module is the plain ActorCritic, policy may be its DDP wrapper
+        self.policy_module = ActorCritic(state_dim, action_dim, action_std).to(device)
+        self.policy = self.policy_module
+        if world_size > 1:
+            self.policy = DDP(self.policy_module, device_ids=[local_rank] if torch.cuda.is_available() else None)
         self.optimizer = torch.optim.Adam(self.policy.parameters(), lr=lr, betas=betas)
         
         self.policy_old = ActorCritic(state_dim, action_dim, action_std).to(device)
         # initial 
-        self.policy_old.load_state_dict(self.policy.state_dict())
+        self.policy_old.load_state_dict(self.policy_module.state_dict())
+        # policy_old is only used to sample rollouts, so run it in bf16 where supported
+        self.rollout_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+        self.policy_old.to(dtype=self.rollout_dtype)
         
-        self.MseLoss = nn.MSELoss()
+        self.fused_loss = fused_loss and torch.cuda.is_available()
+        # the fused kernels are checked against the eager loss on the first batch
+        self._fused_loss_checked = False
+        # pinned host buffer the states are staged in before the async copy to device
+        self._state_buf = None
     def action_selection(self, state, memory):
-        # select action according to the old policy
-        state = torch.FloatTensor(state.reshape(1, -1)).to(device)
-        return self.policy_old.act(state, memory).cpu().data.numpy().flatten()
+        # select actions for a (num_envs, state_dim) batch according to the old policy
+        if self._state_buf is None or self._state_buf.shape != state.shape:
+            self._state_buf = torch.empty(state.shape, pin_memory=torch.cuda.is_available())
+        np.copyto(self._state_buf.numpy(), state)
+        state_t = self._state_buf.to(device, non_blocking=True).to(self.rollout_dtype)
+        action, action_logprob = self.policy_old.act(state_t)
+        # bring action and log prob back in a single device to host sync
+        out = torch.cat((action, action_logprob.unsqueeze(-1)), -1).cpu().numpy()
+        action = out[:, :-1]
+
+        #log in the memory
+        memory.states[memory.ptr] = state
+        memory.actions[memory.ptr] = action
+        memory.logprobs[memory.ptr] = out[:, -1]
+        return action
     
     def update (self, memory):
-        # MC estimate of Return
-        Returns = []
-        disc_reward = 0
-        for reward , is_terminal in zip(reversed(memory.rewards),reversed(memory.is_terminals)) :
-            if is_terminal:
-                disc_reward = 0
-            disc_reward = reward + self.gamma* disc_reward
-            # newest in the first
-            Returns.insert(0,disc_reward)       
-
-        # Normalizing the Returns:here Returns mean return in MC
-        Returns = torch.tensor(Returns).to(device).float()
-        Returns = (Returns - Returns.mean()) / (Returns.std() + 1e-5)
-        # convert list to tensor, old ones need not to be in the grad graph
-        old_states = torch.squeeze(torch.stack(memory.states).to(device), 1).detach()
-        old_actions = torch.squeeze(torch.stack(memory.actions).to(device), 1).detach()
-        old_logprobs = torch.squeeze(torch.stack(memory.logprobs), 1).to(device).detach()
-
-        # optimize for K epochs:
+        # move each buffer to the device in one copy, memory is laid out as (T, num_envs)
+        rewards = torch.from_numpy(memory.rewards).to(device, non_blocking=True)
+        # (1 - done) is built once on the host, the scan uses it there
+        masks_np = (~memory.is_terminals).astype(np.float32)
+        masks = torch.from_numpy(masks_np).to(device, non_blocking=True)
+        old_states = torch.from_numpy(memory.states).to(device, non_blocking=True).flatten(0, 1)
+        old_actions = torch.from_numpy(memory.actions).to(device, non_blocking=True).flatten(0, 1)
+        old_logprobs = torch.from_numpy(memory.logprobs).to(device, non_blocking=True).flatten(0, 1)
+        # recompute the old log probs in fp32 so the ratios start at exactly 1; only valid when
+        # the rollout came from the current weights, not one update behind as with async_rollouts
+        recompute_logprobs = not async_rollouts and self.rollout_dtype != torch.float32
+
+        last_states = torch.from_numpy(memory.last_states).to(device, non_blocking=True)
+
+        # GAE(lambda) estimate of the advantages from the current critic, envs whose
+        # episode is still running at the end of the rollout bootstrap from V(last state)
+        with torch.no_grad():
+            if recompute_logprobs:
+                old_logprobs, values, _ = self.policy_module.evaluate(old_states, old_actions)
+                values = values.view(rewards.shape)
+            else:
+                values = self.policy_module.value(old_states).view(rewards.shape)
+            last_values = self.policy_module.value(last_states)
+        # back to the scale of the rewards for GAE
+        values = values* self.return_rms.std + self.return_rms.mean
+        last_values = last_values* self.return_rms.std + self.return_rms.mean
+        next_values = torch.cat((values[1:], last_values.unsqueeze(0)))
+        deltas = rewards + self.gamma* masks* next_values - values
+        # the advantages are the deltas discounted by gamma*lambda; the backward scan
+        # is a tight sequential loop, so run it jitted on the host instead of launching
+        # a few kernels per time step
+        advantages = discounted_returns(deltas.cpu().numpy(), masks_np, self.gamma* self.gae_lambda)
+        advantages = torch.from_numpy(advantages).to(device, non_blocking=True)
+        Returns = (advantages + values).flatten()
+        # Normalizing the value targets with the running stats of the returns
+        self.return_rms.update(Returns)
+        Returns = (Returns - self.return_rms.mean) / self.return_rms.std
+        # Normalizing the advantages
+        Advantages = advantages.flatten()
+        Advantages = (Advantages - Advantages.mean()) / (Advantages.std() + 1e-5)
+
+        # optimize for K epochs, each one a pass over shuffled mini-batches; all
+        # mini-batches have the same size, the few transitions left over are
+        # dropped for that epoch only
+        batch_size = old_states.size(0)
         for j in range(self.K_epochs):
-            # evalute the old 
-            log_probs, state_values, dist_entropy = self.policy.evaluate(old_states,old_actions)
-        # finding the ratio (pi_theta / pi_theta__old):
-            ratios = torch.exp(log_probs - old_logprobs.detach()).float()
+            perm = torch.randperm(batch_size, device=device)
+            for start in range(0, batch_size - self.mini_batch_size + 1, self.mini_batch_size):
+                idx = perm[start:start+self.mini_batch_size]
+                # evalute the old 
+                log_probs, state_values, dist_entropy = self.policy(old_states[idx],old_actions[idx])
+                # finding the ratio (pi_theta / pi_theta__old):
+                ratios = torch.exp(log_probs - old_logprobs[idx]).float()
 
-        # find the surrogate loss
-        
-        advantages = Returns- state_values.detach()
-        L_CPI = ratios* advantages
-        L_CLIP = torch.min(L_CPI,torch.clamp(ratios,1-self.eps_clip,1+self.eps_clip)*advantages)
-        loss = -L_CLIP + 0.5 * self.MseLoss(state_values, Returns)- 0.01 *dist_entropy
-        
-        # Take gradient step
-        self.optimizer.zero_grad()
-        loss.mean().backward()
-        self.optimizer.step()
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
+                # find the surrogate loss
+                returns = Returns[idx]
+                advantages = Advantages[idx]
+                loss_inputs = (ratios.contiguous(), advantages.contiguous(), state_values.contiguous(),
+                               returns.contiguous(), dist_entropy.contiguous(), self.eps_clip, value_coef, entropy_coef)
+                if self.fused_loss:
+                    if not self._fused_loss_checked:
+                        check_fused_ppo_loss(*loss_inputs)
+                        self._fused_loss_checked = True
+                    loss = FusedPPOLoss.apply(*loss_inputs)
+                else:
+                    loss = ppo_loss(*loss_inputs)
+
+                # Take gradient step
+                self.optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                self.optimizer.step()
+
+    def sync_policy_old(self):
+        # Copy new weights into old policy in place, without building a state dict
+        # (copy_ also casts them to the rollout dtype):
+        with torch.no_grad():
+            for p_old, p_new in zip(self.policy_old.parameters(), self.policy_module.parameters()):
+                p_old.copy_(p_new, non_blocking=True)
 class Memory:
-    def __init__(self):
-        self.actions = []
-        self.states = []
-        self.logprobs = []
-        self.rewards = []
-        self.is_terminals = []
+    # preallocated buffers for T steps of num_envs envs, written in place at ptr
+    def __init__(self, T, num_envs, state_dim, action_dim):
+        self.actions = self._empty((T, num_envs, action_dim), torch.float32)
+        self.states = self._empty((T, num_envs, state_dim), torch.float32)
+        self.logprobs = self._empty((T, num_envs), torch.float32)
+        self.rewards = self._empty((T, num_envs), torch.float32)
+        self.is_terminals = self._empty((T, num_envs), torch.bool)
+        # states after the last step, to bootstrap episodes cut by the end of the rollout
+        self.last_states = self._empty((num_envs, state_dim), torch.float32)
+        self.ptr = 0
+    
+    @staticmethod
+    def _empty(shape, dtype):
+        # numpy view of a host tensor, pinned when there is a GPU so that
+        # each buffer goes to the device in a single async copy
+        return torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available()).numpy()
     
     def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.is_terminals[:]
+        self.ptr = 0
+def all_reduce_sum(values):
+    # sum a list of numbers over all ranks, no-op for a single process
+    if world_size == 1:
+        return values
+    values = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(values)
+    return values.tolist()
+
+def collect_rollout(env, ppo, memory, state, episode_rewards, episode_lengths, stream=None):
+    # run the old policy until memory is full, issuing its forwards on stream;
+    # episode_rewards/lengths carry unfinished episodes over to the next rollout.
+    # returns the next states and the count, summed reward and summed length
+    # of the episodes finished on the way
+    finished = [0, 0, 0]
+    memory.clear_memory()
+    with torch.cuda.stream(stream):
+        while memory.ptr < len(memory.rewards):
+            # Running policy_old on all envs at once:
+            action = ppo.action_selection(state, memory)
+            state, reward, done, _ = env.step(action)
+            
+            # Saving reward and is_terminals:
+            memory.rewards[memory.ptr] = reward
+            memory.is_terminals[memory.ptr] = done
+            memory.ptr += 1
+            
+            episode_rewards += reward
+            episode_lengths += 1
+            if render:
+                env.call("render")
+            
+            for n in np.flatnonzero(done):
+                finished[0] += 1
+                finished[1] += episode_rewards[n]
+                finished[2] += episode_lengths[n]
+                episode_rewards[n] = 0
+                episode_lengths[n] = 0
+    memory.last_states[:] = state
+    return state, finished
+
 def main():
+    if world_size > 1:
+        if torch.cuda.is_available():
+            torch.cuda.set_device(device)
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
     
-    # creating environment
-    env = gym.make(env_name)
-    state_dim = env.observation_space.shape[0]
-    action_dim = env.action_space.shape[0]
+    # creating num_envs copies of the environment stepped in parallel,
+    # finished episodes are reset automatically
+    env = gym.vector.AsyncVectorEnv(
+        [lambda: gym.make(env_name, max_episode_steps=max_timesteps) for _ in range(num_envs)])
+    state_dim = env.single_observation_space.shape[0]
+    action_dim = env.single_action_space.shape[0]
     
     if random_seed:
         print("Random Seed: {}".format(random_seed))
-        torch.manual_seed(random_seed)
-        env.seed(random_seed)
-        np.random.seed(random_seed)
+        # each rank collects its own rollouts, so give them distinct seeds
+        torch.manual_seed(random_seed + rank)
+        env.seed(random_seed + rank * num_envs)
+        np.random.seed(random_seed + rank)
+    
+    # number of vector env steps between two updates, the rollout is split over the ranks
+    rollout_len = update_timestep // (num_envs * world_size)
+    # double buffered: one memory is learned on while the other one is filled
+    memories = [Memory(rollout_len, num_envs, state_dim, action_dim) for _ in range(2)]
+    ppo = PPO(state_dim, action_dim, action_std, lr, betas, gamma, gae_lambda, K_epochs, eps_clip, mini_batch_size)
+    if rank == 0:
+        print(lr,betas)
     
-    memory = Memory()
-    ppo = PPO(state_dim, action_dim, action_std, lr, betas, gamma, K_epochs, eps_clip)
-    print(lr,betas)
+    if async_rollouts:
+        executor = ThreadPoolExecutor(max_workers=1)
+        # the rollout forwards go on their own stream to overlap with the update
+        rollout_stream = torch.cuda.Stream(device) if torch.cuda.is_available() else None
     
-    # logging variables
+    # logging variables, summed over all ranks at every update
     running_reward = 0
     average_length = 0
-    time_step = 0
+    log_episodes = 0
+    i_episode = 0
+    episode_rewards = np.zeros(num_envs)
+    episode_lengths = np.zeros(num_envs, dtype=int)
     
     # training loop
-    for i_episode in range(1, max_episodes+1):
-        state = env.reset()
-        for t in range(max_timesteps):
-            time_step +=1
-            # Running policy_old:
-            action = ppo.action_selection(state, memory)
-            state, reward, done, _ = env.step(action)
-            
-            # Saving reward and is_terminals:
-            memory.rewards.append(reward)
-            memory.is_terminals.append(done)
-            
-            # update if its time
-            if time_step % update_timestep == 0:
-                ppo.update(memory)
-                memory.clear_memory()
-                time_step = 0
-            running_reward += reward
-            if render:
-                env.render()
-            if done:
-                break
+    state = env.reset()
+    state, finished = collect_rollout(env, ppo, memories[0], state, episode_rewards, episode_lengths)
+    while i_episode < max_episodes:
+        if async_rollouts:
+            # the old policy fills the other memory while the policy learns on this one,
+            # so each rollout lags the trained policy by one update
+            if rollout_stream is not None:
+                rollout_stream.wait_stream(torch.cuda.current_stream(device))
+            future = executor.submit(collect_rollout, env, ppo, memories[1], state,
+                                     episode_rewards, episode_lengths, rollout_stream)
+            ppo.update(memories[0])
+            state, next_finished = future.result()
+            ppo.sync_policy_old()
+        else:
+            ppo.update(memories[0])
+            ppo.sync_policy_old()
+            state, next_finished = collect_rollout(env, ppo, memories[1], state, episode_rewards, episode_lengths)
+        memories.reverse()
         
-        average_length += t
+        # ranks are in lockstep here, so gather the episode stats of the rollout
+        # just learned on and let every rank see the same episode count
+        n_episodes, n_reward, n_length = all_reduce_sum(finished)
+        finished = next_finished
+        i_episode += int(n_episodes)
+        log_episodes += int(n_episodes)
+        running_reward += n_reward
+        average_length += n_length
         
         # save every 500 episodes
-        if i_episode % 500 == 0:
-            torch.save(ppo.policy.state_dict(), './PPO_continuous_{}.pth'.format(env_name))
+        if rank == 0 and i_episode // 500 > (i_episode - n_episodes) // 500:
+            torch.save(ppo.policy_module.state_dict(), './PPO_continuous_{}.pth'.format(env_name))
             
         # logging
-        if i_episode % log_interval == 0:
-            average_length = int(average_length/log_interval)
-            running_reward = int((running_reward/log_interval))
+        if log_episodes >= log_interval:
+            average_length = int(average_length/log_episodes)
+            running_reward = int((running_reward/log_episodes))
             
-            print('Episode {} \t average length: {} \t average reward: {}'.format(i_episode, average_length, running_reward))
+            if rank == 0:
+                print('Episode {} \t average length: {} \t average reward: {}'.format(i_episode, average_length, running_reward))
             running_reward = 0
             average_length = 0
+            log_episodes = 0
+    
+    if async_rollouts:
+        executor.shutdown()
+    if world_size > 1:
+        dist.destroy_process_group()
             
 if __name__ == '__main__':
     main()